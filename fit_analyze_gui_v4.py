@@ -11,124 +11,166 @@ Version V4:
 """
 
 import argparse
+import io
 import json
-import math
+import os
 import sys
-from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from fitparse import FitFile
 
 try:
-    import tkinter as tk
-    from tkinter import filedialog, simpledialog, messagebox
+    import orjson
 except Exception:
-    tk = None
+    orjson = None
 
-import pandas as pd
-from fitparse import FitFile
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except Exception:
+    pa = None
 
 SEMICIRCLES_TO_DEGREES = 180 / (2**31)
 LOCAL_TZ = "Europe/Berlin"
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+RECORD_FIELDS = (
+    "timestamp", "position_lat", "position_long", "altitude", "speed",
+    "distance", "heart_rate", "cadence", "power", "temperature",
+)
+TIMESERIES_COLUMNS = [
+    "latitude_deg", "longitude_deg", "altitude_m", "speed_m_s",
+    "distance_m", "heart_rate_bpm", "cadence_rpm", "power_w", "temperature_c",
+]
 
 
 # --- Helper functions ---------------------------------------------------------
-def to_float(v) -> Optional[float]:
-    try:
-        if v is None:
-            return None
-        return float(v)
-    except Exception:
-        return None
+def haversine_segments_m(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Abstände zwischen aufeinanderfolgenden Punkten (vektorisiert, NaN → 0)."""
+    R = 6371000.0
+    phi = np.radians(lat)
+    dphi = np.diff(phi); dlmb = np.diff(np.radians(lon))
+    a = np.sin(dphi/2)**2 + np.cos(phi[:-1])*np.cos(phi[1:])*np.sin(dlmb/2)**2
+    seg = 2*R*np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return np.where(np.isnan(seg), 0.0, seg)
 
 
-def semicircles_to_deg(val) -> Optional[float]:
-    v = to_float(val)
-    if v is None:
-        return None
-    return v * SEMICIRCLES_TO_DEGREES
+def timestamp_deltas_s(timestamps: pd.Series) -> np.ndarray:
+    """Zeitschritte in Sekunden, erster Eintrag 0; fehlende Zeitstempel → 0."""
+    ts = timestamps.to_numpy(dtype="datetime64[ns]")
+    dt_s = np.diff(ts) / np.timedelta64(1, "s")
+    return np.concatenate(([0.0], np.nan_to_num(dt_s)))
 
 
-def haversine_m(lat1, lon1, lat2, lon2) -> float:
-    if None in (lat1, lon1, lat2, lon2):
-        return 0.0
-    R = 6371000.0
-    phi1 = math.radians(lat1); phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1); dlmb = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlmb/2)**2
-    return 2*R*math.atan2(math.sqrt(a), math.sqrt(1-a))
+def nan_mean_max(arr: np.ndarray) -> Tuple[Optional[float], Optional[float]]:
+    """Mittelwert und Maximum ohne NaN; (None, None) wenn keine Werte vorhanden."""
+    valid = ~np.isnan(arr)
+    if not valid.any():
+        return None, None
+    vals = arr[valid]
+    return float(vals.mean()), float(vals.max())
 
 
-def positive_gain(series: pd.Series) -> float:
-    if series.empty:
+def positive_gain(arr: np.ndarray) -> float:
+    if arr.size < 2:
         return 0.0
-    diffs = series.diff()
-    return float(diffs[diffs > 0].sum(skipna=True) or 0.0)
+    d = np.diff(arr)
+    d = np.where(np.isnan(d), 0.0, d)
+    return float(np.maximum(d, 0.0).sum())
 
 
 # --- FIT Parsing --------------------------------------------------------------
-def parse_fit_records(fit_path: Path) -> pd.DataFrame:
-    fit = FitFile(fit_path.as_posix())
-    records = []
-    for msg in fit.get_messages("record"):
-        data = {d.name: d.value for d in msg}
-        ts = data.get("timestamp")
-        if isinstance(ts, datetime):
-            ts = ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts.astimezone(timezone.utc)
-        rec = {
-            "timestamp": ts,
-            "latitude_deg": semicircles_to_deg(data.get("position_lat")),
-            "longitude_deg": semicircles_to_deg(data.get("position_long")),
-            "altitude_m": to_float(data.get("altitude")),
-            "speed_m_s": to_float(data.get("speed")),
-            "distance_m": to_float(data.get("distance")),
-            "heart_rate_bpm": to_float(data.get("heart_rate")),
-            "cadence_rpm": to_float(data.get("cadence")),
-            "power_w": to_float(data.get("power")),
-            "temperature_c": to_float(data.get("temperature")),
-        }
-        records.append(rec)
-    df = pd.DataFrame.from_records(records)
+def parse_fit(fit_path: Path) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """Liest die FIT-Datei in einem Durchlauf: Zeitreihe sowie Sessions/Laps."""
+    # Datei in einem Stück lesen; fitparse dekodiert dann aus dem Speicher
+    fit = FitFile(io.BytesIO(fit_path.read_bytes()))
+    # Spaltenweise sammeln: eine Liste pro Feld, fehlende Felder als None
+    cols = {name: [] for name in RECORD_FIELDS}
+    n = 0
+    sessions, laps = [], []
+    for msg in fit.get_messages(("record", "session", "lap")):
+        if msg.name == "record":
+            for d in msg.fields:
+                col = cols.get(d.name)
+                if col is None:
+                    continue
+                if len(col) > n:
+                    col[n] = d.value
+                else:
+                    col.append(d.value)
+            n += 1
+            for col in cols.values():
+                if len(col) < n:
+                    col.append(None)
+        elif msg.name == "session":
+            sessions.append({d.name: d.value for d in msg})
+        else:
+            laps.append({d.name: d.value for d in msg})
+    return build_records_df(cols), {"sessions": sessions, "laps": laps}
+
+
+def build_records_df(cols: Dict[str, list]) -> pd.DataFrame:
+    def num(name: str) -> np.ndarray:
+        return pd.to_numeric(pd.Series(cols[name], dtype=object), errors="coerce").to_numpy(dtype=np.float64)
+
+    df = pd.DataFrame({
+        "timestamp": pd.to_datetime(cols["timestamp"], utc=True, errors="coerce"),
+        "latitude_deg": num("position_lat") * SEMICIRCLES_TO_DEGREES,
+        "longitude_deg": num("position_long") * SEMICIRCLES_TO_DEGREES,
+        "altitude_m": num("altitude"),
+        "speed_m_s": num("speed"),
+        "distance_m": num("distance"),
+        "heart_rate_bpm": num("heart_rate"),
+        "cadence_rpm": num("cadence"),
+        "power_w": num("power"),
+        "temperature_c": num("temperature"),
+    })
     if not df.empty:
-        df = df.sort_values("timestamp").reset_index(drop=True)
+        # FIT-Records sind zeitlich geordnet; nur bei Verletzung oder fehlenden Zeitstempeln sortieren
+        ts = df["timestamp"].to_numpy(dtype="datetime64[ns]")
+        if np.isnat(ts).any() or (np.diff(ts.view(np.int64)) < 0).any():
+            df = df.sort_values("timestamp").reset_index(drop=True)
         # Distanz rekonstruieren falls leer
-        if df["distance_m"].isna().all() or (to_float(df["distance_m"].max(skipna=True)) or 0) == 0:
-            dists = [0.0]
-            for i in range(1, len(df)):
-                d = haversine_m(df.at[i-1, "latitude_deg"], df.at[i-1, "longitude_deg"],
-                                df.at[i, "latitude_deg"], df.at[i, "longitude_deg"])
-                dists.append(dists[-1] + (d or 0.0))
-            df["distance_m"] = dists
+        if df["distance_m"].isna().all() or df["distance_m"].max(skipna=True) == 0:
+            lat = df["latitude_deg"].to_numpy(dtype=np.float64)
+            lon = df["longitude_deg"].to_numpy(dtype=np.float64)
+            seg = haversine_segments_m(lat, lon)
+            df["distance_m"] = np.concatenate(([0.0], np.cumsum(seg)))
         # Geschwindigkeit rekonstruieren
         if df["speed_m_s"].isna().mean() > 0.5:
-            dt = df["timestamp"].diff().dt.total_seconds().fillna(0)
-            ds = df["distance_m"].diff().fillna(0)
-            dt_safe = dt.mask(dt == 0)
-            v = (ds / dt_safe).fillna(0.0).astype("float64")
-            df["speed_m_s"] = v
+            dt_s = timestamp_deltas_s(df["timestamp"])
+            dist = df["distance_m"].to_numpy(dtype=np.float64)
+            ds = np.nan_to_num(np.diff(dist, prepend=dist[0]))
+            df["speed_m_s"] = np.divide(ds, dt_s, out=np.zeros_like(ds), where=dt_s != 0)
         # Höhe interpolieren
-        if df["altitude_m"].notna().sum() > 5:
-            df["altitude_m"] = df["altitude_m"].interpolate(limit_direction="both")
+        alt = df["altitude_m"].to_numpy(dtype=np.float64, copy=True)
+        missing = np.isnan(alt)
+        if (~missing).sum() > 5 and missing.any():
+            idx = np.arange(len(alt))
+            alt[missing] = np.interp(idx[missing], idx[~missing], alt[~missing])
+            df["altitude_m"] = alt
     return df
 
 
+def parse_fit_records(fit_path: Path) -> pd.DataFrame:
+    return parse_fit(fit_path)[0]
+
+
 def parse_sessions_and_laps(fit_path: Path) -> Dict[str, Any]:
-    fit = FitFile(fit_path.as_posix())
-    sessions, laps = [], []
-    for msg in fit.get_messages("session"):
-        sessions.append({d.name: d.value for d in msg})
-    for msg in fit.get_messages("lap"):
-        laps.append({d.name: d.value for d in msg})
-    return {"sessions": sessions, "laps": laps}
+    return parse_fit(fit_path)[1]
 
 
-def integrate_work_joules(df: pd.DataFrame) -> float:
+def integrate_work_joules(df: pd.DataFrame, dt_s: Optional[np.ndarray] = None) -> float:
     if df.empty or df["power_w"].notna().sum() < 2:
         return 0.0
-    power = df["power_w"].fillna(0.0).astype(float)
-    dt = df["timestamp"].diff().dt.total_seconds().fillna(0.0)
-    p_prev = power.shift(1).fillna(0.0)
-    work = ((power + p_prev) / 2.0) * dt
-    return float(work.sum())
+    if dt_s is None:
+        dt_s = timestamp_deltas_s(df["timestamp"])
+    power = np.nan_to_num(df["power_w"].to_numpy(dtype=np.float64))
+    # Trapezregel über die vorberechneten Zeitschritte
+    return float(np.dot((power[1:] + power[:-1]) / 2.0, dt_s[1:]))
 
 
 # --- Metrics ------------------------------------------------------------------
@@ -142,26 +184,25 @@ def compute_metrics(df: pd.DataFrame, agg: Dict[str, Any],
     start_ts_utc = df["timestamp"].min()
     end_ts_utc = df["timestamp"].max()
     elapsed_s = (end_ts_utc - start_ts_utc).total_seconds()
+    dt_s = timestamp_deltas_s(df["timestamp"])
 
-    moving_mask = (df["speed_m_s"].fillna(0) > 0.5)
-    moving_s = float(df.loc[moving_mask, "timestamp"].diff().dt.total_seconds().fillna(0).sum())
+    # Bewegungszeit: Zeitschritte, an deren Ende die Geschwindigkeit > 0.5 m/s ist
+    speed = df["speed_m_s"].to_numpy(dtype=np.float64)
+    moving_s = float(np.where(speed[1:] > 0.5, dt_s[1:], 0.0).sum())
 
-    total_dist_m = float(df["distance_m"].max(skipna=True) or 0.0)
+    total_dist_m = nan_mean_max(df["distance_m"].to_numpy(dtype=np.float64))[1] or 0.0
     avg_speed_m_s = total_dist_m / elapsed_s if elapsed_s > 0 else 0.0
-    max_speed_m_s = float(df["speed_m_s"].max() or 0.0)
+    max_speed_m_s = nan_mean_max(speed)[1] or 0.0
 
-    ascent_m = positive_gain(df["altitude_m"]) if "altitude_m" in df else 0.0
+    ascent_m = positive_gain(df["altitude_m"].to_numpy(dtype=np.float64))
 
-    hr_avg = float(df["heart_rate_bpm"].mean()) if df["heart_rate_bpm"].notna().any() else None
-    hr_max = float(df["heart_rate_bpm"].max()) if df["heart_rate_bpm"].notna().any() else None
-    cad_avg = float(df["cadence_rpm"].mean()) if df["cadence_rpm"].notna().any() else None
-    cad_max = float(df["cadence_rpm"].max()) if df["cadence_rpm"].notna().any() else None
-    pwr_avg = float(df["power_w"].mean()) if df["power_w"].notna().any() else None
-    pwr_max = float(df["power_w"].max()) if df["power_w"].notna().any() else None
-    temp_avg = float(df["temperature_c"].mean()) if df["temperature_c"].notna().any() else None
+    hr_avg, hr_max = nan_mean_max(df["heart_rate_bpm"].to_numpy(dtype=np.float64))
+    cad_avg, cad_max = nan_mean_max(df["cadence_rpm"].to_numpy(dtype=np.float64))
+    pwr_avg, pwr_max = nan_mean_max(df["power_w"].to_numpy(dtype=np.float64))
+    temp_avg, _ = nan_mean_max(df["temperature_c"].to_numpy(dtype=np.float64))
 
     # Fahrerarbeit
-    rider_work_J = integrate_work_joules(df)
+    rider_work_J = integrate_work_joules(df, dt_s)
     rider_work_Wh = rider_work_J / 3600.0
 
     # Motorenergie aus Wall-Messung
@@ -186,8 +227,8 @@ def compute_metrics(df: pd.DataFrame, agg: Dict[str, Any],
     # Zeit in Berlin
     start_local = start_ts_utc.tz_convert(LOCAL_TZ)
     end_local = end_ts_utc.tz_convert(LOCAL_TZ)
-    start_str = start_local.strftime("%Y-%m-%dT%H:%M:%S%z")
-    end_str = end_local.strftime("%Y-%m-%dT%H:%M:%S%z")
+    start_str = start_local.strftime(ISO_FORMAT)
+    end_str = end_local.strftime(ISO_FORMAT)
 
     summary = {
         "start_time": start_str,
@@ -225,19 +266,57 @@ def compute_metrics(df: pd.DataFrame, agg: Dict[str, Any],
 # --- Export -------------------------------------------------------------------
 def export_timeseries_csv(df: pd.DataFrame, out_prefix: Path) -> Path:
     out_csv = out_prefix.with_suffix(".csv")
-    df_out = df.copy()
-    df_out["timestamp_iso"] = df_out["timestamp"].dt.tz_convert(LOCAL_TZ).dt.strftime("%Y-%m-%dT%H:%M:%S%z")
-    cols = [
-        "timestamp_iso",
-        "latitude_deg", "longitude_deg", "altitude_m", "speed_m_s",
-        "distance_m", "heart_rate_bpm", "cadence_rpm", "power_w", "temperature_c"
-    ]
-    df_out[cols].to_csv(out_csv, index=False, sep=';', decimal=',')
+    opts = arrow_csv_options()
+    if opts is None:
+        ts_iso = df["timestamp"].dt.tz_convert(LOCAL_TZ).dt.strftime(ISO_FORMAT)
+        # Nur die Zeitspalte ist neu; die Messspalten werden nicht kopiert
+        df_out = pd.DataFrame({"timestamp_iso": ts_iso, **{c: df[c] for c in TIMESERIES_COLUMNS}}, copy=False)
+        df_out.to_csv(out_csv, index=False, sep=';', decimal=',')
+        return out_csv
+    # Arrow formatiert %S mit Sekundenbruchteilen; FIT-Zeitstempel sind ganze Sekunden
+    ts_local = pc.cast(pa.array(df["timestamp"]), pa.timestamp("s", tz=LOCAL_TZ), safe=False)
+    try:
+        ts_iso = pc.strftime(ts_local, format=ISO_FORMAT)
+    except pa.ArrowException:
+        # Arrow ohne Zeitzonen-Datenbank (z. B. Windows ohne tzdata)
+        ts_iso = pa.array(df["timestamp"].dt.tz_convert(LOCAL_TZ).dt.strftime(ISO_FORMAT))
+    tbl = pa.table({"timestamp_iso": ts_iso,
+                    **{c: decimal_comma_strings(df[c].to_numpy(dtype=np.float64)) for c in TIMESERIES_COLUMNS}})
+    pacsv.write_csv(tbl, out_csv, opts)
     return out_csv
 
 
+def arrow_csv_options() -> Optional["pacsv.WriteOptions"]:
+    """CSV-Optionen für pyarrow; None ohne pyarrow oder bei zu alter Version (eol/quoting_*)."""
+    if pa is None:
+        return None
+    try:
+        return pacsv.WriteOptions(delimiter=";", eol=os.linesep,
+                                  quoting_style="none", quoting_header="none")
+    except TypeError:
+        return None
+
+
+def decimal_comma_strings(values: np.ndarray) -> "pa.Array":
+    """Float-Werte als Text wie bei pandas.to_csv(decimal=','): repr-Format, '.' → ','."""
+    txt = pa.array(values.astype(str), mask=np.isnan(values))
+    return pc.replace_substring(txt, pattern=".", replacement=",")
+
+
+def export_timeseries_parquet(df: pd.DataFrame, out_prefix: Path) -> Path:
+    """Zeitreihe als Parquet (benötigt pyarrow); Zeitstempel bleiben in UTC."""
+    out_parquet = out_prefix.with_suffix(".parquet")
+    cols = ["timestamp"] + TIMESERIES_COLUMNS
+    df[cols].to_parquet(out_parquet, engine="pyarrow", compression="zstd", index=False)
+    return out_parquet
+
+
 def export_summary_json(summary: Dict[str, Any], out_prefix: Path) -> Path:
     out_json = out_prefix.with_suffix(".json")
+    if orjson is not None:
+        opts = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        out_json.write_bytes(orjson.dumps(summary, option=opts))
+        return out_json
     with open(out_json, "w", encoding="utf-8") as f:
         json.dump(summary, f, ensure_ascii=False, indent=2)
     return out_json
@@ -245,7 +324,11 @@ def export_summary_json(summary: Dict[str, Any], out_prefix: Path) -> Path:
 
 # --- GUI Inputs ---------------------------------------------------------------
 def ask_user_inputs_gui() -> Optional[Dict[str, Any]]:
-    if tk is None:
+    # Tkinter erst hier laden, damit CLI-Aufrufe ohne GUI-Bibliotheken starten
+    try:
+        import tkinter as tk
+        from tkinter import filedialog, simpledialog
+    except Exception:
         return None
     root = tk.Tk(); root.withdraw(); root.update()
     try:
@@ -271,9 +354,11 @@ def main():
     ap.add_argument("--wall-energy-kwh", type=float, default=0.5, help="Nachladeenergie aus der Steckdose (kWh)")
     ap.add_argument("--wall2battery-eff-pct", type=float, default=82.5, help="Effizienz Wall→Battery in %")
     ap.add_argument("--muscle-eff-pct", type=float, default=24.0, help="Muskeleffizienz in % (Default 24)")
+    ap.add_argument("--parquet", action="store_true", help="Zeitreihe als Parquet statt CSV exportieren (benötigt pyarrow)")
     args = ap.parse_args()
 
-    if args.fit_file:
+    used_gui = not args.fit_file
+    if not used_gui:
         inputs = {"fit_file": args.fit_file,
                   "wall_energy_kWh": args.wall_energy_kwh,
                   "eff_pct": args.wall2battery_eff_pct,
@@ -290,21 +375,29 @@ def main():
     out_prefix = fit_path.with_suffix("")
     out_prefix = out_prefix.parent / f"{fit_path.stem}_analysis"
 
-    df = parse_fit_records(fit_path)
-    agg = parse_sessions_and_laps(fit_path)
+    df, agg = parse_fit(fit_path)
     summary = compute_metrics(df, agg,
                               wall_energy_kWh=inputs.get("wall_energy_kWh"),
                               eff_wall2batt_pct=inputs.get("eff_pct"),
                               muscle_eff_pct=inputs.get("muscle_eff"))
 
-    out_csv = export_timeseries_csv(df, out_prefix)
+    if args.parquet:
+        try:
+            out_ts = export_timeseries_parquet(df, out_prefix)
+        except ImportError:
+            print("Parquet-Export benötigt pyarrow (pip install pyarrow)."); sys.exit(3)
+        ts_label = "Parquet"
+    else:
+        out_ts = export_timeseries_csv(df, out_prefix)
+        ts_label = "CSV"
     out_json = export_summary_json(summary, out_prefix)
 
-    print(f"CSV: {out_csv}")
+    print(f"{ts_label}: {out_ts}")
     print(f"JSON: {out_json}")
-    if tk is not None:
+    if used_gui:
         try:
-            messagebox.showinfo("Fertig", f"CSV und JSON gespeichert:\n{out_csv}\n{out_json}")
+            from tkinter import messagebox
+            messagebox.showinfo("Fertig", f"{ts_label} und JSON gespeichert:\n{out_ts}\n{out_json}")
         except Exception:
             pass
 